@@ -1,7 +1,13 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import orjson
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
 st.set_page_config(layout="wide")
 st.title("Coletor Histórico de Textos ALMG")
@@ -11,73 +17,243 @@ HEADERS = {
     "Accept": "application/json",
     "User-Agent": "Mozilla/5.0"
 }
+URL_NORMAS = f"{API_BASE}/legislacao/mineira"
+TIMEOUT = 20
+ITENS_POR_PAGINA = 200
+# páginas da listagem pedidas em paralelo a cada rodada
+PAGINAS_POR_LOTE = 8
+
+# textos mantidos no cache em memória do servidor (~dezenas de KB cada)
+MAX_TEXTOS_EM_CACHE = 5_000
+
+# tipoDoc da API para cada versão do texto
+TIPO_DOC_ORIGINAL = 142
+TIPO_DOC_CONSOLIDADO = 572
+
+# limite de requisições simultâneas na coleta (também dimensiona o pool de conexões)
+MAX_WORKERS = 16
+
+# intervalo mínimo (s) entre atualizações da barra de progresso durante a coleta
+INTERVALO_PROGRESSO = 0.25
+
+# teto de requisições por segundo à API, somando todas as threads e sessões do processo
+REQUISICOES_POR_SEGUNDO = 20
+
+
+# token bucket entre threads: rajadas de até `capacidade`, depois `taxa` por segundo;
+# quem chega sem token reserva o próximo e dorme fora do lock
+class LimitadorTaxa:
+
+    def __init__(self, taxa, capacidade):
+        self._taxa = taxa
+        self._capacidade = capacidade
+        self._tokens = capacidade
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def aguardar(self):
+        with self._lock:
+            agora = time.monotonic()
+            self._tokens = min(
+                self._capacidade,
+                self._tokens + (agora - self._ultimo) * self._taxa
+            )
+            self._ultimo = agora
+            self._tokens -= 1
+            espera = -self._tokens / self._taxa if self._tokens < 0 else 0
+
+        if espera:
+            time.sleep(espera)
+
+
+# repetições do urllib3 também passam pelo limitador, para o teto valer sob erros
+class RetryLimitado(Retry):
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        obter_limitador().aguardar()
+
+
+# o Streamlit recria o módulo a cada rerun/sessão; o cache_resource garante uma só
+# sessão HTTP e um só limitador por processo: as conexões TCP/TLS com a API são
+# reaproveitadas entre reruns e o teto vale entre sessões e execuções interrompidas
+@st.cache_resource(show_spinner=False)
+def recursos_http():
+    limitador = LimitadorTaxa(REQUISICOES_POR_SEGUNDO, MAX_WORKERS)
+
+    sessao = requests.Session()
+    sessao.headers.update(HEADERS)
+    sessao.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=MAX_WORKERS,
+            # 429/5xx transitórios são repetidos com backoff em vez de virar texto vazio
+            max_retries=RetryLimitado(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False
+            )
+        )
+    )
+
+    return sessao, limitador
+
+
+def obter_sessao():
+    return recursos_http()[0]
+
+
+def obter_limitador():
+    return recursos_http()[1]
 
 
 # ==============================
 # LISTAR NORMAS POR ANO
 # ==============================
-def listar_normas_por_ano(ano):
+# página vazia (fim da listagem); levantada dentro da função cacheada para que o
+# fim nunca fique no cache e normas novas apareçam na próxima varredura
+class FimListagem(Exception):
+    pass
+
+
+# a listagem não filtra por ano: cada ano do intervalo percorre as mesmas
+# páginas, então elas são baixadas uma vez e reaproveitadas entre anos e reruns
+@st.cache_data(show_spinner=False, ttl=60 * 60)
+def _baixar_pagina(pagina):
+    params = {
+        "pagina": pagina,
+        "itensPorPagina": ITENS_POR_PAGINA
+    }
+
+    obter_limitador().aguardar()
+    resp = obter_sessao().get(URL_NORMAS, params=params, timeout=TIMEOUT)
+
+    # falhas viram exceção, que o st.cache_data não guarda
+    resp.raise_for_status()
+
+    data = orjson.loads(resp.content)
+    lista = data.get("listaNormaJuridica", [])
+
+    if not lista:
+        raise FimListagem()
+
+    return lista
+
+
+def baixar_pagina(pagina):
+    # None indica falha; lista vazia indica o fim da listagem
+    try:
+        return _baixar_pagina(pagina)
+
+    except FimListagem:
+        return []
+
+    except Exception:
+        return None
+
+
+def listar_normas_por_ano(ano, executor):
     normas_ano = []
+    vistas = set()
     pagina = 1
 
     while True:
-        url = f"{API_BASE}/legislacao/mineira"
-        params = {
-            "pagina": pagina,
-            "itensPorPagina": 200
-        }
-
-        try:
-            resp = requests.get(url, headers=HEADERS, params=params, timeout=20)
-            if resp.status_code != 200:
-                break
+        # busca um lote de páginas em paralelo; a primeira vazia encerra a listagem.
+        # uma página com falha também encerra, mas marca o ano como incompleto
+        lote = executor.map(baixar_pagina, range(pagina, pagina + PAGINAS_POR_LOTE))
 
-            data = resp.json()
-            lista = data.get("listaNormaJuridica", [])
+        for lista in lote:
+            if lista is None:
+                return normas_ano, False
 
             if not lista:
-                break
+                return normas_ano, True
 
             for norma in lista:
-                if norma.get("ano") == ano:
-                    normas_ano.append(norma)
+                if norma.get("ano") != ano:
+                    continue
 
-            pagina += 1
+                # a paginação pode repetir normas; evita buscar o texto duas vezes
+                chave = (norma.get("siglaTipoNorma"), norma.get("numero"))
+                if chave in vistas:
+                    continue
 
-        except Exception:
-            break
+                vistas.add(chave)
+                normas_ano.append(norma)
 
-    return normas_ano
+        pagina += PAGINAS_POR_LOTE
 
 
 # ==============================
 # BUSCAR TEXTO
 # ==============================
-def buscar_texto(tipo, numero, ano, tipo_doc):
-    url = f"{API_BASE}/legislacao/mineira/{tipo}/{numero}/{ano}/documento"
+# textos de normas quase nunca mudam: reruns e novas coletas reaproveitam o cache.
+# o cache é do processo (todas as sessões), por isso limitado em entradas
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60, max_entries=MAX_TEXTOS_EM_CACHE)
+def _baixar_texto(tipo, numero, ano, tipo_doc):
+    url = f"{URL_NORMAS}/{tipo}/{numero}/{ano}/documento"
     params = {
         "conteudo": "true",
         "texto": "true",
         "tipoDoc": str(tipo_doc)
     }
 
-    try:
-        resp = requests.get(url, headers=HEADERS, params=params, timeout=20)
-        if resp.status_code != 200:
-            return None
+    obter_limitador().aguardar()
+    resp = obter_sessao().get(url, params=params, timeout=TIMEOUT)
+    if resp.status_code == 404:
+        return None
 
-        data = resp.json()
-        lista = data.get("listaNormaDocumento", [])
+    # demais falhas viram exceção, que o st.cache_data não guarda
+    resp.raise_for_status()
 
-        if not lista:
-            return None
+    data = orjson.loads(resp.content)
+    lista = data.get("listaNormaDocumento", [])
 
-        return lista[0].get("texto", None)
+    if not lista:
+        return None
+
+    return lista[0].get("texto", None)
+
+
+def buscar_texto(tipo, numero, ano, tipo_doc):
+    try:
+        return _baixar_texto(tipo, numero, ano, tipo_doc)
 
     except Exception:
         return None
 
 
+# ==============================
+# EXPORTAR
+# ==============================
+# formato -> (nome do arquivo, mime)
+FORMATOS = {
+    "Parquet": ("textos_normas_almg.parquet", "application/vnd.apache.parquet"),
+    "CSV (.gz)": ("textos_normas_almg.csv.gz", "application/gzip")
+}
+
+
+def exportar(df, formato):
+    buffer = BytesIO()
+
+    if formato == "Parquet":
+        # parquet (pyarrow) grava bem mais rápido e menor que CSV para os textos
+        df.to_parquet(buffer, index=False, compression="zstd")
+    else:
+        # grava direto em bytes comprimidos, sem montar a string CSV inteira
+        df.to_csv(
+            buffer,
+            index=False,
+            encoding="utf-8-sig",
+            compression={"method": "gzip", "compresslevel": 1},
+            chunksize=10_000
+        )
+
+    return buffer.getvalue()
+
+
 # ==============================
 # INTERFACE
 # ==============================
@@ -89,53 +265,126 @@ anos = st.slider(
     (1947, 2026)
 )
 
+workers = st.slider(
+    "Requisições simultâneas",
+    1,
+    MAX_WORKERS,
+    8
+)
+
 if st.button("🚀 Iniciar coleta automática"):
 
-    resultados = []
     total_anos = anos[1] - anos[0] + 1
-    progresso_ano = 0
 
-    progress_bar = st.progress(0)
+    progress_bar = st.progress(0, text="Listando normas...")
 
-    for ano in range(anos[0], anos[1] + 1):
+    executor = ThreadPoolExecutor(max_workers=workers)
 
-        normas = listar_normas_por_ano(ano)
+    try:
 
-        for norma in normas:
-            tipo = norma.get("siglaTipoNorma")
-            numero = norma.get("numero")
+        # lista o intervalo todo antes (após o primeiro ano as páginas vêm do cache)
+        chaves = []
+        anos_incompletos = []
+        for i, ano in enumerate(range(anos[0], anos[1] + 1), 1):
+            normas, completa = listar_normas_por_ano(ano, executor)
+            if not completa:
+                anos_incompletos.append(str(ano))
+
+            for norma in normas:
+                chaves.append((norma.get("siglaTipoNorma"), norma.get("numero"), ano))
+
+            progress_bar.progress(i / total_anos, text=f"Listando normas de {ano}...")
+
+        if anos_incompletos:
+            st.warning(
+                "Falha ao consultar a listagem da API; as normas destes anos podem "
+                f"estar incompletas: {', '.join(anos_incompletos)}. "
+                "Rode a coleta novamente para completar."
+            )
+
+        # um único pipeline de textos para o intervalo: nenhum ano espera o anterior.
+        # original e consolidado de cada norma entram juntos na fila, na ordem da leitura
+        pares = []
+        for tipo, numero, ano in chaves:
+            pares.append((
+                executor.submit(buscar_texto, tipo, numero, ano, TIPO_DOC_ORIGINAL),
+                executor.submit(buscar_texto, tipo, numero, ano, TIPO_DOC_CONSOLIDADO)
+            ))
+
+        # resultados acumulados por coluna (evita um dict por norma)
+        resultados = {
+            "tipo_sigla": [tipo for tipo, _, _ in chaves],
+            "numero": [numero for _, numero, _ in chaves],
+            "ano": [ano for _, _, ano in chaves],
+            "texto_original": [],
+            "texto_consolidado": []
+        }
 
-            texto_original = buscar_texto(tipo, numero, ano, 142)
-            texto_consolidado = buscar_texto(tipo, numero, ano, 572)
+        # barra atualizada por tempo, não por contagem: cada chamada st é também onde
+        # o Streamlit percebe stop/rerun, então a latência de parada fica limitada
+        total = len(chaves)
+        ultima_atualizacao = time.monotonic()
 
-            resultados.append({
-                "tipo_sigla": tipo,
-                "numero": numero,
-                "ano": ano,
-                "texto_original": texto_original,
-                "texto_consolidado": texto_consolidado
-            })
+        for i, (original, consolidado) in enumerate(pares, 1):
+            resultados["texto_original"].append(original.result())
+            resultados["texto_consolidado"].append(consolidado.result())
 
-        progresso_ano += 1
-        progress_bar.progress(progresso_ano / total_anos)
+            agora = time.monotonic()
+            if agora - ultima_atualizacao >= INTERVALO_PROGRESSO or i == total:
+                progress_bar.progress(i / total, text=f"Coletando textos ({i}/{total})...")
+                ultima_atualizacao = agora
 
-        # pequena pausa para não sobrecarregar API
-        time.sleep(0.3)
+    finally:
+        # se o Streamlit interromper o script (stop/rerun), descarta a fila pendente
+        # em vez de esperar (e bater na API por) textos que ninguém vai ler
+        executor.shutdown(wait=False, cancel_futures=True)
 
     df = pd.DataFrame(resultados)
 
     if df.empty:
+        st.session_state.pop("coleta", None)
         st.warning("Nenhum dado retornado. Verifique intervalo.")
     else:
-        st.success("Coleta finalizada!")
-        st.dataframe(df.head())
+        # prévia leve: os textos completos ficam só nos arquivos baixados
+        previa = df.head().copy()
+        for col in ("texto_original", "texto_consolidado"):
+            previa[col] = previa[col].map(
+                lambda t: t[:300] if isinstance(t, str) else t
+            )
+
+        # guarda na sessão só o parquet comprimido (zstd), não os textos crus:
+        # qualquer rerun (inclusive trocar o formato ou clicar no download)
+        # reexibe a coleta sem refazer requisições
+        st.session_state["coleta"] = {
+            "previa": previa,
+            "arquivos": {"Parquet": exportar(df, "Parquet")}
+        }
+        del df, resultados
 
-        csv = df.to_csv(index=False).encode("utf-8-sig")
 
-        st.download_button(
-            label="⬇️ Baixar CSV completo",
-            data=csv,
-            file_name="textos_normas_almg.csv",
-            mime="text/csv"
-        )
+# ==============================
+# RESULTADO
+# ==============================
+
+coleta = st.session_state.get("coleta")
+
+if coleta:
+    st.success("Coleta finalizada!")
+    st.dataframe(coleta["previa"])
+
+    formato = st.radio("Formato do arquivo", list(FORMATOS), horizontal=True)
+    nome_arquivo, mime = FORMATOS[formato]
+
+    # outros formatos são gerados a partir do parquet guardado, uma vez por coleta
+    arquivos = coleta["arquivos"]
+    if formato not in arquivos:
+        df = pd.read_parquet(BytesIO(arquivos["Parquet"]))
+        arquivos[formato] = exportar(df, formato)
+        del df
 
+    st.download_button(
+        label=f"⬇️ Baixar {formato} completo",
+        data=arquivos[formato],
+        file_name=nome_arquivo,
+        mime=mime
+    )